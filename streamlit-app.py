@@ -1,15 +1,18 @@
 import streamlit as st
-import boto3
 import json
-import os
 import re
 from datetime import datetime
-import base64
-import uuid
 from pathlib import Path
 import time
+import random
 import logging
-from botocore.config import Config
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+import threading
+from contextlib import contextmanager
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Set page configuration
 st.set_page_config(
@@ -25,13 +28,18 @@ if 'file_name' not in st.session_state:
     st.session_state.file_name = ""
 if 'folder_name' not in st.session_state:
     st.session_state.folder_name = ""
+if 'generated_code_bytes' not in st.session_state:
+    st.session_state.generated_code_bytes = b""
 
 # Function to read the system prompt file
+# Cached since Streamlit reruns the script on every interaction and the file does not change
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
 def load_system_prompt():
     with open("advaned-system-prompts.txt", "r") as file:
         return file.read()
 
 # Function to load example prompts
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
 def load_example_prompts():
     with open("advanced-example-prompts.txt", "r") as file:
         return file.read()
@@ -59,298 +67,548 @@ Please provide the complete code implementation.
     return prompt
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
+# Log calls only enqueue records; a background listener thread writes them to the console and
+# log file, so file I/O never blocks Bedrock calls. The root logger's QueueHandler marks that
+# setup already ran, so reruns (and Streamlit's "Clear cache") don't add duplicate handlers.
+def start_log_listener():
+    root_logger = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [
         logging.StreamHandler(),
         logging.FileHandler('bedrock_api.log')
     ]
-)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on shutdown
+    
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+
+start_log_listener()
 logger = logging.getLogger('bedrock_api')
 
+# Stage 2 sub-prompts; each only depends on the stage 1 scaffold so they can run concurrently
+STAGE2_TASKS = {
+    "models": "detailed model definitions",
+    "utils": "utility functions and helpers",
+    "config": "configuration modules and environment handling",
+}
+
+# Function to generate the stage 1 scaffold, cached so repeated requirements reuse it
+@st.cache_data(ttl=60 * 60, show_spinner=False)
+def generate_scaffold(system_prompt, user_prompt, stage1_prompt, latency_optimized=True):
+    return st.write_stream(invoke_claude_model(system_prompt, stage1_prompt, latency_optimized=latency_optimized, prompt_prefix=user_prompt))
+
+# Function to collect a full (non-streamed) response from Claude
+def collect_claude_response(system_prompt, user_prompt, latency_optimized=True, prompt_prefix=None):
+    return "".join(invoke_claude_model(system_prompt, user_prompt, latency_optimized=latency_optimized, prompt_prefix=prompt_prefix))
+
+# Function to run the stage 2 sub-prompts concurrently
+async def generate_stage2_parts(system_prompt, user_prompt, prompts, latency_optimized=True):
+    # Worker threads share the script's context so the cached client and breaker lookups work there
+    ctx = get_script_run_ctx()
+    
+    def collect_in_context(prompt):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return collect_claude_response(system_prompt, prompt, latency_optimized, user_prompt)
+    
+    # boto3 clients are thread-safe, so each blocking call runs in its own worker thread
+    return await asyncio.gather(*(
+        asyncio.to_thread(collect_in_context, prompt)
+        for prompt in prompts
+    ))
+
+# Seconds between UI heartbeats; kept well below typical 30-60s proxy idle timeouts
+HEARTBEAT_INTERVAL = 10
+
+# Context manager that keeps the Streamlit connection active while waiting on Bedrock
+# A background thread refreshes a placeholder so proxies never see an idle connection
+@contextmanager
+def heartbeat(message, interval=HEARTBEAT_INTERVAL):
+    placeholder = st.empty()
+    stop = threading.Event()
+    start_time = time.time()
+    
+    def beat():
+        while not stop.wait(interval):
+            placeholder.text(f"{message} ({time.time() - start_time:.0f}s elapsed)")
+    
+    thread = threading.Thread(target=beat, daemon=True)
+    add_script_run_ctx(thread)  # Allow the thread to update the current session's UI
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        placeholder.empty()
+
 # Function to generate code in stages to avoid timeout issues
-def generate_code_in_stages(system_prompt, user_prompt):
+def generate_code_in_stages(system_prompt, user_prompt, latency_optimized=True):
     logger.info("Starting staged code generation process")
     
+    # Every stage shares the system prompt and user_prompt as a cached prefix,
+    # so the stage prompts below only carry the stage-specific instructions
+    
     # Stage 1: Generate initial code scaffold with basic structure
-    stage1_prompt = f"{user_prompt}\n\nStart by generating the overall structure of the Node.js Express API with the main file organization and essential imports."
-    stage1_result = invoke_claude_model(system_prompt, stage1_prompt)
+    # Streamed into the UI as tokens arrive; st.write_stream returns the full text
+    stage1_prompt = "Start by generating the overall structure of the Node.js Express API with the main file organization and essential imports."
+    with heartbeat("Generating API structure..."):
+        stage1_result = generate_scaffold(system_prompt, user_prompt, stage1_prompt, latency_optimized)
     
     # Log progress and update UI
     logger.info("Stage 1 complete: Code scaffold generated")
     st.text("✓ Generated API structure and scaffolding")
     
-    # Stage 2: Generate model definitions and utility functions
-    stage2_prompt = f"{user_prompt}\n\nBased on the following initial code structure, please expand it with detailed model definitions and utility functions:\n\n{stage1_result}"
-    stage2_result = invoke_claude_model(system_prompt, stage2_prompt)
+    # Later stages get a structural digest of the code so far instead of the full text,
+    # which keeps their input size roughly constant; each stage only outputs its own files
+    
+    # Stage 2: Generate models, utilities and configuration in parallel
+    stage1_digest = summarize_code_structure(stage1_result)
+    stage2_prompts = [
+        f"Based on the following initial code structure, please expand it with {task}. Only output the files for this part:\n\n{stage1_digest}"
+        for task in STAGE2_TASKS.values()
+    ]
+    with heartbeat("Generating models, utilities and configuration..."):
+        stage2_parts = asyncio.run(generate_stage2_parts(system_prompt, user_prompt, stage2_prompts, latency_optimized))
+    stage2_result = "\n\n".join(stage2_parts)
+    st.markdown(stage2_result)
     
     # Log progress and update UI
-    logger.info("Stage 2 complete: Models and utilities generated")
-    st.text("✓ Generated models and utility functions")
+    logger.info(f"Stage 2 complete: {', '.join(STAGE2_TASKS)} generated")
+    st.text("✓ Generated models, utility functions and configuration")
     
     # Stage 3: Generate route handlers and OpenSearch integration
-    stage3_prompt = f"{user_prompt}\n\nBased on the following code with models and utilities, please complete the implementation with detailed route handlers and OpenSearch integration:\n\n{stage2_result}"
-    final_result = invoke_claude_model(system_prompt, stage3_prompt)
+    stage2_digest = summarize_code_structure(f"{stage1_result}\n\n{stage2_result}")
+    stage3_prompt = f"Based on the following code with models, utilities and configuration, please complete the implementation with detailed route handlers and OpenSearch integration. Only output new or changed files:\n\n{stage2_digest}"
+    with heartbeat("Generating routes and OpenSearch integration..."):
+        final_result = st.write_stream(invoke_claude_model(system_prompt, stage3_prompt, latency_optimized=latency_optimized, prompt_prefix=user_prompt))
     
     # Log completion and return final code
     logger.info("Stage 3 complete: Full code generation finished")
     st.text("✓ Generated routes and OpenSearch integration")
     
-    return final_result
+    # Every stage only emits its own files, so the full project is the combined output;
+    # files repeated by a later stage are written last and take precedence when saved
+    return f"{stage1_result}\n\n{stage2_result}\n\n{final_result}"
 
-# Function to invoke Claude model on AWS Bedrock with retry mechanism
-def invoke_claude_model(system_prompt, user_prompt, max_retries=3):
-    # Configure the AWS SDK with custom timeouts
+# Function to run the staged generation, memoized on its inputs
+# Re-submitting the same requirement (or a double click) returns the cached result instead of
+# calling Bedrock again; Streamlit hashes the arguments to build the cache key
+@st.cache_data(ttl=60 * 60, show_spinner=False)
+def cached_generate(system_prompt, user_requirement, latency_optimized=True):
+    return generate_code_in_stages(system_prompt, format_prompt(user_requirement), latency_optimized)
+
+# Function to create the Bedrock runtime client once per process
+# Reusing the client keeps its HTTPS connection pool (and TLS sessions) alive across calls
+# boto3 is imported here rather than at module level since its import is slow and is
+# only needed when the client is first created
+# One client is cached per read timeout, so retries with a longer timeout get their own client
+@st.cache_resource
+def get_bedrock_client(read_timeout=75):
+    import boto3
+    from botocore.config import Config
+    
+    # Configure the AWS SDK with custom timeouts, kept just above the observed p95 to fail fast
     config = Config(
         region_name='us-east-1',
-        connect_timeout=120,  # 2 minutes connection timeout
-        read_timeout=300,     # 5 minutes read timeout
-        retries={'max_attempts': 0}  # We'll handle retries manually
+        connect_timeout=10,         # 10 seconds connection timeout
+        read_timeout=read_timeout,  # Max wait between streamed chunks
+        retries={'max_attempts': 0},  # We'll handle retries manually
+        tcp_keepalive=True,
+        max_pool_connections=20
     )
+    return boto3.client('bedrock-runtime', config=config)
+
+# Circuit breaker settings: after repeated service-side failures, fail fast for a cool-down window
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLDOWN = 30  # seconds
+# Error codes that indicate Bedrock itself is struggling (5xx responses also count)
+# Compared lowercased: errors raised inside the response stream use lowerCamel member names
+CIRCUIT_BREAKER_ERROR_CODES = {
+    'throttlingexception',
+    'serviceunavailableexception',
+    'internalserverexception',
+    'modelnotreadyexception',
+    'modelstreamerrorexception',
+    'modeltimeoutexception',
+}
+
+# Function to get the shared circuit breaker state
+# Held in st.cache_resource because Streamlit re-executes the script (and any module-level
+# state) on every rerun, which would otherwise reset the breaker between generations
+@st.cache_resource
+def get_circuit_breaker():
+    # The lock guards updates from the concurrent stage 2 worker threads
+    return {'fails': 0, 'open_until': 0, 'lock': threading.Lock()}
+
+# Function to record a service-side failure, opening the circuit once the threshold is reached
+def record_circuit_failure():
+    breaker = get_circuit_breaker()
+    with breaker['lock']:
+        breaker['fails'] += 1
+        if breaker['fails'] >= CIRCUIT_BREAKER_THRESHOLD:
+            breaker['open_until'] = time.time() + CIRCUIT_BREAKER_COOLDOWN
+            logger.warning(f"Circuit breaker opened for {CIRCUIT_BREAKER_COOLDOWN} seconds after {breaker['fails']} consecutive failures")
+
+MODEL_ID = "us.anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+# Function to get the model IDs for which latency-optimized inference was rejected
+# Remembered across calls and reruns so only the first request pays for the failed attempt
+@st.cache_resource
+def get_standard_latency_models():
+    return set()
+
+# Function to invoke Claude model on AWS Bedrock with retry mechanism
+# Streams the response, yielding text chunks as they arrive
+def invoke_claude_model(system_prompt, user_prompt, max_retries=3, latency_optimized=True, prompt_prefix=None, max_backoff=20):
+    breaker = get_circuit_breaker()
     
-    bedrock_runtime = boto3.client('bedrock-runtime', config=config)
-    
-    # Initial setup for token chunking
-    max_tokens_per_request = 2000  # Smaller chunks to avoid timeouts
+    # Mark the system prompt (and the shared prompt prefix, if any) for prompt caching
+    # so repeated calls within the cache window skip re-processing them
+    user_content = []
+    if prompt_prefix:
+        user_content.append({"type": "text", "text": prompt_prefix, "cache_control": {"type": "ephemeral"}})
+    user_content.append({"type": "text", "text": user_prompt})
     
     # Prepare the base request body
     request_body = {
         "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": max_tokens_per_request,
-        "system": system_prompt,
+        "max_tokens": 4096,
+        "system": [
+            {
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
         "messages": [
             {
                 "role": "user",
-                "content": user_prompt
+                "content": user_content
             }
         ],
         "temperature": 0.2,
         "top_p": 0.9,
     }
     
+    # Inference latency mode; falls back to standard where optimized is unsupported
+    standard_latency_models = get_standard_latency_models()
+    latency = 'optimized' if latency_optimized and MODEL_ID not in standard_latency_models else 'standard'
+    fell_back_to_standard = False
+    
     # Retry logic
     retries = 0
-    full_response = ""
     
     while retries <= max_retries:
+        # Fail fast while the circuit is open instead of hammering a struggling service
+        if time.time() < breaker['open_until']:
+            raise RuntimeError("Bedrock circuit breaker is open, please try again shortly")
+        
+        # Track whether any text reached the caller; a stream cannot be retried once it has
+        received_text = False
         try:
             logger.info(f"Making Bedrock API call (attempt {retries+1}/{max_retries+1})")
             start_time = time.time()
             
-            # Make the API call
-            response = bedrock_runtime.invoke_model(
-                modelId="us.anthropic.claude-3-5-sonnet-20240620-v1:0",
-                body=json.dumps(request_body)
+            # Keep the first attempt and first retry tight; allow more room for outliers after that
+            bedrock_runtime = get_bedrock_client(read_timeout=75 if retries <= 1 else 60 + 30 * retries)
+            
+            # Make the streaming API call
+            response = bedrock_runtime.invoke_model_with_response_stream(
+                modelId=MODEL_ID,
+                body=json.dumps(request_body),
+                performanceConfigLatency=latency
             )
             
-            # Process response
-            response_body = json.loads(response.get('body').read())
-            response_text = response_body.get('content')[0].get('text')
-            full_response += response_text
+            # Process response events as they arrive
+            for event in response['body']:
+                chunk = json.loads(event['chunk']['bytes'])
+                
+                if chunk['type'] == 'content_block_delta':
+                    text = chunk['delta'].get('text', '')
+                    if text:
+                        received_text = True
+                        yield text
+                elif chunk['type'] == 'message_delta':
+                    if chunk['delta'].get('stop_reason') == 'max_tokens':
+                        logger.info("Response truncated due to token limit")
+                elif chunk['type'] == 'message_stop':
+                    break
             
             # Log successful completion
             elapsed_time = time.time() - start_time
             logger.info(f"API call successful. Elapsed time: {elapsed_time:.2f} seconds")
+            with breaker['lock']:
+                breaker['fails'] = 0
             
-            # If we need more content, update the prompt for the next request
-            if len(response_text) >= max_tokens_per_request * 0.9:  # If we're getting close to the limit
-                # For staged generation, we would update the user_prompt here
-                # But for this initial implementation, we'll return what we have
-                logger.info("Response truncated due to token limit")
-                break
-            
-            # If we got a complete response, break out of the retry loop
-            return full_response
+            # The standard retry worked, so the ValidationException was down to latency mode
+            if fell_back_to_standard:
+                standard_latency_models.add(MODEL_ID)
+            return
             
         except Exception as e:
             elapsed_time = time.time() - start_time
             logger.error(f"API call failed after {elapsed_time:.2f} seconds: {str(e)}")
+            
+            # Classify the failure from the botocore error response, if any
+            # HTTP-level errors such as timeouts carry response=None rather than a dict
+            error_response = getattr(e, 'response', None) or {}
+            error_code = error_response.get('Error', {}).get('Code')
+            status_code = error_response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            
+            # Timeouts mean Bedrock is not responding; retry them and count them towards the breaker
+            from botocore.exceptions import ConnectTimeoutError, EventStreamError, ReadTimeoutError
+            timed_out = isinstance(e, (ConnectTimeoutError, ReadTimeoutError))
+            
+            # Errors inside the response stream carry a synthetic 400 status; apart from validation
+            # errors they are raised by the service mid-generation, so classify them as service-side
+            if isinstance(e, EventStreamError):
+                status_code = 0
+                stream_failure = (error_code or '').lower() != 'validationexception'
+            else:
+                stream_failure = False
+            
+            service_failure = (
+                timed_out
+                or stream_failure
+                or (error_code or '').lower() in CIRCUIT_BREAKER_ERROR_CODES
+                or status_code >= 500
+            )
+            if service_failure:
+                record_circuit_failure()
+            
+            if received_text:
+                # Partial output has already been streamed to the caller
+                logger.error("Stream interrupted after partial output, not retrying")
+                raise
+            
+            if latency == 'optimized' and error_code == 'ValidationException':
+                # Latency-optimized inference may not be available for this model/region;
+                # it is only remembered once the standard request succeeds
+                logger.warning("Latency-optimized inference rejected, retrying with standard")
+                fell_back_to_standard = True
+                latency = 'standard'
+                continue
+            
+            if not service_failure and (400 <= status_code < 500 or isinstance(e, EventStreamError)):
+                # Client errors (validation, access denied, ...) will not succeed on retry
+                logger.error(f"Non-retryable client error: {error_code}")
+                raise
+            
+            if time.time() < breaker['open_until']:
+                logger.error("Circuit breaker open, not retrying")
+                raise
+            
             retries += 1
             
             if retries <= max_retries:
-                # Exponential backoff
-                wait_time = 2 ** retries
-                logger.info(f"Retrying in {wait_time} seconds...")
+                # Exponential backoff with full jitter so concurrent sessions don't retry in lockstep
+                wait_time = random.uniform(0, min(2 ** retries, max_backoff))
+                logger.info(f"Retrying in {wait_time:.2f} seconds...")
                 time.sleep(wait_time)
             else:
                 logger.error(f"Maximum retries ({max_retries}) exceeded")
                 raise
-    
-    return full_response
 
 # Function to save generated code to file
-def save_code_to_file(code, folder_name, file_name):
+def save_code_to_file(code, folder_name, file_name, files_to_create=None):
     # Create folder if it doesn't exist
     folder_path = Path("generatedcode") / folder_name
     folder_path.mkdir(parents=True, exist_ok=True)
     
-    # Check if the code contains references to additional files
-    files_to_create = extract_file_references(code)
+    # Keep the encoded code for the download button so it doesn't re-read the file on every rerun
+    st.session_state.generated_code_bytes = code.encode("utf-8")
+    
+    # Check if the code contains references to additional files, unless already parsed
+    if files_to_create is None:
+        files_to_create, _ = extract_file_references(code)
     
     # If we have structured files, save them individually
     if files_to_create and len(files_to_create) > 0:
         logger.info(f"Found {len(files_to_create)} structured files to create")
         
+        # Create each distinct subdirectory once rather than once per file
+        sub_dirs = {(folder_path / file_info['path']).parent for file_info in files_to_create}
+        sub_dirs.discard(folder_path)
+        for sub_dir in sub_dirs:
+            sub_dir.mkdir(parents=True, exist_ok=True)
+        
         for file_info in files_to_create:
-            # Create subdirectories if needed
-            file_path_parts = file_info['path'].split('/')
-            filename = file_path_parts[-1]
-            
-            if len(file_path_parts) > 1:
-                # There are subdirectories in the path
-                subdir = '/'.join(file_path_parts[:-1])
-                file_dir = folder_path / subdir
-                file_dir.mkdir(parents=True, exist_ok=True)
-            
             # Save the file
             sub_file_path = folder_path / file_info['path']
-            with open(sub_file_path, "w") as file:
-                file.write(file_info['content'])
+            sub_file_path.write_text(file_info['content'], encoding="utf-8")
             
             logger.info(f"Created file: {sub_file_path}")
             
         # Use the first file as our main file for display purposes
         main_file_path = folder_path / files_to_create[0]['path']
-        # Update the code for display in the UI
-        code = files_to_create[0]['content']
         
         return str(main_file_path)
     else:
         # Save as a single file if no structured files were detected
         logger.info("No structured files found, saving as a single file")
         file_path = folder_path / file_name
-        with open(file_path, "w") as file:
-            file.write(code)
+        file_path.write_text(code, encoding="utf-8")
         
         return str(file_path)
 
+# File path as it appears in file headers, e.g. src/models/user.js
+FILE_PATH_PATTERN = r'[\w\-./]+\.\w+'
+
+# Single multi-line regex covering every supported file header style, one alternative per style
+# in priority order. Each alternative has exactly one named group, so match.lastgroup identifies it.
+_FILE_RE = re.compile(
+    # Pattern 1: Explicit file path headers like '**src/app.js**' or 'src/app.js:' or '# src/app.js'
+    r'^[^\n]*?\*\*(?P<bold_header>{path})\*\*'
+    r'|^[^\S\n]*(?P<colon_header>{path}):[^\S\n]*$'
+    r'|^[^\S\n]*#[^\S\n]+(?P<hash_header>{path})[^\S\n]*$'
+    # Pattern 2: Numbered file references like '1. src/models/user.js'
+    r'|^[^\S\n]*\d+\.[^\S\n]+(?P<numbered>{path})[^\S\n]*$'
+    # Pattern 3: Commented file references like '// filename: src/config/db.js'
+    r'|^[^\n]*?//[^\S\n]*filename:[^\S\n]*(?P<comment>{path})[^\S\n]*$'
+    # Pattern 4: File path before code block like 'src/app.js' followed by ```
+    r'|^[^\S\n]*(?P<before_block>{path})[^\S\n]*(?=\n[^\S\n]*```)'
+    # Pattern 5: Code blocks with file path embedded in the language specifier ```js:src/app.js
+    r'|^[^\S\n]*```\w*:(?P<fence_path>{path})[^\S\n]*$'.format(path=FILE_PATH_PATTERN),
+    re.MULTILINE
+)
+
+# Function to find the next code fence line at or after pos, scanning the string directly
+# Returns (line_start, line_end) or None; closing=True only accepts a bare ``` line
+def find_fence_line(code, pos, closing=False):
+    idx = code.find('```', pos)
+    while idx >= 0:
+        line_start = code.rfind('\n', 0, idx) + 1
+        line_end = code.find('\n', idx)
+        if line_end < 0:
+            line_end = len(code)
+        
+        # The fence must open its line (indentation allowed) and, when closing, be alone on it
+        # The common unindented / bare-fence cases are checked by index, without slicing
+        if line_start >= pos and (line_start == idx or code[line_start:idx].isspace()):
+            if not closing or line_end == idx + 3 or code[idx + 3:line_end].isspace():
+                return line_start, line_end
+        
+        # Only the first fence on a line can open it, so skip the rest of this line
+        idx = code.find('```', line_end)
+    return None
+
 # Function to extract file references and content from generated code
+# Returns the structured files and the code to display, from a single parse of the response
 def extract_file_references(code):
     files = []
-    lines = code.split('\n')
     
-    # Process multiple file blocks in the response
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        
-        # Pattern 1: Explicit file path headers like '**src/app.js**' or 'src/app.js:' or '# src/app.js'
-        file_header_match = re.search(r'\*\*([\w\-./]+\.\w+)\*\*|^([\w\-./]+\.\w+):$|^#\s+([\w\-./]+\.\w+)$', line)
-        
-        # Pattern 2: Numbered file references like '1. src/models/user.js'
-        numbered_file_match = re.search(r'^\d+\.\s+([\w\-./]+\.\w+)\s*$', line)
+    # Process multiple file blocks in the response in a single pass over the text
+    pos = 0  # Everything before pos has already been consumed as file content
+    for match in _FILE_RE.finditer(code):
+        # Skip header-like lines inside a code block we already captured
+        if match.start() < pos:
+            continue
         
-        # Pattern 3: Commented file references like '// filename: src/config/db.js'
-        comment_file_match = re.search(r'//\s*filename:\s*([\w\-./]+\.\w+)\s*$', line)
+        file_path = match.group(match.lastgroup)
         
-        # Pattern 4: File path before code block like 'src/app.js' followed by ```
-        if i + 1 < len(lines) and (lines[i+1].strip().startswith('```')):
-            file_before_block_match = re.search(r'^([\w\-./]+\.\w+)\s*$', line)
+        if match.lastgroup == 'fence_path':
+            # The header line is the opening fence itself
+            content_start = match.end() + 1
         else:
-            file_before_block_match = None
-        
-        # If any file path pattern matched
-        if file_header_match or numbered_file_match or comment_file_match or file_before_block_match:
-            # Extract the file path from whichever match succeeded
-            if file_header_match:
-                # Get the first non-None group
-                file_path = next(g for g in file_header_match.groups() if g is not None)
-            elif numbered_file_match:
-                file_path = numbered_file_match.group(1)
-            elif comment_file_match:
-                file_path = comment_file_match.group(1)
-            elif file_before_block_match:
-                file_path = file_before_block_match.group(1)
-            
-            # Move to next line to find code block
-            j = i + 1
             # Skip any explanatory text until we find a code block
-            while j < len(lines) and not lines[j].strip().startswith('```'):
-                j += 1
-            
-            # If we found a code block
-            if j < len(lines) and lines[j].strip().startswith('```'):
-                j += 1  # Skip the opening ```
-                code_content = []
-                
-                # Collect all content until closing ```
-                while j < len(lines) and not lines[j].strip() == '```':
-                    code_content.append(lines[j])
-                    j += 1
-                
-                # Add file with its content
-                files.append({
-                    'path': file_path,
-                    'content': '\n'.join(code_content)
-                })
-                
-                # Move outer loop index to after this code block
-                if j < len(lines):
-                    i = j + 1
-                else:
-                    i = j
+            opening = find_fence_line(code, match.end())
+            if not opening:
                 continue
+            content_start = opening[1] + 1  # Skip the opening ```
         
-        # Pattern 5: Code blocks with file path embedded in the language specifier ```js:src/app.js
-        code_block_with_path_match = re.search(r'^```\w*:([\w\-./]+\.\w+)$', line)
-        if code_block_with_path_match:
-            file_path = code_block_with_path_match.group(1)
-            
-            # Extract content between code blocks
-            j = i + 1
-            code_content = []
-            while j < len(lines) and not lines[j].strip() == '```':
-                code_content.append(lines[j])
-                j += 1
-            
-            # Add file with its content
-            files.append({
-                'path': file_path,
-                'content': '\n'.join(code_content)
-            })
-            
-            # Move outer loop index to after this code block
-            if j < len(lines):
-                i = j + 1
-            else:
-                i = j
-            continue
+        # Collect all content until closing ```
+        closing = find_fence_line(code, content_start, closing=True)
+        content_end = closing[0] - 1 if closing else len(code)
         
-        i += 1
-    
-    # Special case: If we only got a single block of code with no filename, assume it's app.js
-    if len(files) == 0 and '```' in code:
-        code_parts = code.split('```')
-        if len(code_parts) >= 3:
-            code_content = code_parts[1]
-            # Remove language identifier if present (e.g., "js\n")
-            if "\n" in code_content:
-                parts = code_content.split("\n", 1)
-                if len(parts) > 1:
-                    code_content = parts[1]
-            files.append({
-                'path': 'app.js',  # Default filename
-                'content': code_content
-            })
-    
-    # Make sure we have at least some files
-    # If there's actual code but no files detected, create a default file structure
-    if len(files) == 0 and len(code) > 100 and not all(f['path'] for f in files):
+        # Add file with its content
         files.append({
-            'path': 'app.js',  # Default main file
-            'content': code.strip()
+            'path': file_path,
+            'content': code[content_start:content_end] if content_end > content_start else ''
         })
+        
+        # Continue scanning after this code block
+        pos = closing[1] if closing else len(code)
     
-    return files
+    # Later stages may rewrite a file from an earlier stage: keep one entry per path, in order of
+    # first appearance, holding the last version written
+    files = list({file_info['path']: file_info for file_info in files}.values())
+    
+    # Special case: If we only got a single block of code with no filename, assume it's app.js
+    # Locate the first pair of fences with find rather than splitting the whole response
+    if not files:
+        first_fence = code.find('```')
+        if first_fence < 0:
+            # No code fences at all: the whole response is the code
+            if code.strip():
+                files.append({
+                    'path': 'app.js',  # Default main file
+                    'content': code.strip()
+                })
+        else:
+            second_fence = code.find('```', first_fence + 3)
+            if second_fence >= 0:
+                content_start = first_fence + 3
+                # Remove language identifier if present (e.g., "js\n")
+                newline = code.find('\n', content_start, second_fence)
+                if newline >= 0:
+                    content_start = newline + 1
+                files.append({
+                    'path': 'app.js',  # Default filename
+                    'content': code[content_start:second_fence]
+                })
+    
+    # The first file is the one shown in the UI; fall back to the raw response
+    display_code = files[0]['content'] if files else code
+    
+    return files, display_code
+
+# Function/class declarations, Express route registrations and exports in generated JavaScript
+_SIGNATURE_RE = re.compile(
+    r'^[^\S\n]*(?:export[^\S\n]+)?(?:async[^\S\n]+)?function\b[^\n{]*'
+    r'|^[^\S\n]*(?:export[^\S\n]+)?(?:const|let|var)[^\S\n]+\w+[^\S\n]*=[^\S\n]*(?:async[^\S\n]*)?(?:function\b[^\n{]*|\([^)\n]*\)[^\S\n]*=>|\w+[^\S\n]*=>)'
+    r'|^[^\S\n]*(?:export[^\S\n]+)?class[^\S\n]+\w+(?:[^\S\n]+extends[^\S\n]+[\w.]+)?'
+    r'|^[^\S\n]+(?:static[^\S\n]+)?(?:async[^\S\n]+)?(?!(?:if|for|while|switch|catch|return)\b)\w+[^\S\n]*\([^)\n]*\)[^\S\n]*(?=\{)'
+    r'|^[^\S\n]*(?:router|app)\.(?:get|post|put|patch|delete|use)\([^\n]*'
+    r'|^[^\S\n]*module\.exports[^\S\n]*=[^\n]*',
+    re.MULTILINE
+)
+
+# Function to build a compact structural digest of generated code for the next stage's prompt
+# Lists every file with its signatures and includes only the most recently added file in full
+def summarize_code_structure(code):
+    files, _ = extract_file_references(code)
+    if not files:
+        return code
+    
+    summary = ["FILES SO FAR:"]
+    for file_info in files:
+        summary.append(f"- {file_info['path']}")
+        for signature in _SIGNATURE_RE.finditer(file_info['content']):
+            summary.append(f"    {signature.group(0).strip().rstrip('{').rstrip()}")
+    
+    latest_file = files[-1]
+    summary.append(f"\nMOST RECENT FILE ({latest_file['path']}):\n```\n{latest_file['content']}\n```")
+    return "\n".join(summary)
 
-# Function to create a download link for the generated code
-def get_binary_file_downloader_html(file_path, file_name):
-    with open(file_path, 'rb') as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode()
-    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{file_name}">Download {file_name}</a>'
-    return href
+# Function to list the files of a generated project, relative to the generatedcode folder
+# Cached since Streamlit reruns the script on every interaction; the folder mtime is part of
+# the cache key so adding files invalidates it, and the short TTL covers nested changes
+@st.cache_data(ttl=10, show_spinner=False)
+def list_project_files(folder_name, mtime):
+    return sorted(
+        str(p.relative_to("generatedcode"))
+        for p in (Path("generatedcode") / folder_name).rglob("*")
+        if p.is_file()
+    )
 
 # Main UI layout
 st.title("AWS Bedrock Code Generator")
@@ -393,6 +651,8 @@ with col2:
         value="index.js"
     )
 
+latency_optimized = st.checkbox("Latency-optimized inference", value=True)
+
 # Action button
 if st.button("Generate Code"):
     if user_requirement:
@@ -401,33 +661,13 @@ if st.button("Generate Code"):
                 # Load system prompt
                 system_prompt = load_system_prompt()
                 
-                # Format user prompt
-                user_prompt = format_prompt(user_requirement)
-                
-                # Generate code in stages to avoid timeouts
+                # Format the user prompt and generate code in stages to avoid timeouts
                 st.text("Generating code in stages to avoid timeouts...")
-                generated_code = generate_code_in_stages(system_prompt, user_prompt)
+                generated_code = cached_generate(system_prompt, user_requirement, latency_optimized)
                 
-                # Extract code from potential markdown code blocks in the response
-                if "```" in generated_code:
-                    # Extract code between the first and last code block markers
-                    code_parts = generated_code.split("```")
-                    if len(code_parts) >= 3:
-                        # If the format is ```js\ncode\n```
-                        # code_parts[0] is text before the first marker
-                        # code_parts[1] might be "js\ncode" or just "code"
-                        code_content = code_parts[1]
-                        # Remove language identifier if present (e.g., "js\n")
-                        if "\n" in code_content:
-                            # Split by first newline
-                            parts = code_content.split("\n", 1)
-                            if len(parts) > 1:
-                                code_content = parts[1]
-                        st.session_state.generated_code = code_content
-                    else:
-                        st.session_state.generated_code = generated_code
-                else:
-                    st.session_state.generated_code = generated_code
+                # Extract the files and the code to display from the markdown response
+                files_to_create, display_code = extract_file_references(generated_code)
+                st.session_state.generated_code = display_code
                 
                 st.session_state.file_name = file_name
                 st.session_state.folder_name = folder_name
@@ -436,7 +676,8 @@ if st.button("Generate Code"):
                 file_path = save_code_to_file(
                     st.session_state.generated_code, 
                     st.session_state.folder_name, 
-                    st.session_state.file_name
+                    st.session_state.file_name,
+                    files_to_create
                 )
                 
                 st.success(f"Code generated and saved to {file_path}")
@@ -466,14 +707,10 @@ if st.session_state.generated_code:
         folder_path = Path("generatedcode") / st.session_state.folder_name
         if folder_path.exists():
             st.subheader("Project Structure")
-            all_files = []
-            for root, dirs, files in os.walk(folder_path):
-                rel_path = os.path.relpath(root, start=Path("generatedcode"))
-                for file in files:
-                    all_files.append(os.path.join(rel_path, file))
+            all_files = list_project_files(st.session_state.folder_name, folder_path.stat().st_mtime)
             
             if all_files:
-                st.code("\n".join(sorted(all_files)), language="bash")
+                st.code("\n".join(all_files), language="bash")
             else:
                 st.info("No files found in project directory.")
     
@@ -483,13 +720,10 @@ if st.session_state.generated_code:
     
     # Download link
     if st.session_state.file_name and st.session_state.folder_name:
-        file_path = f"generatedcode/{st.session_state.folder_name}/{st.session_state.file_name}"
-        
         # Create download button
-        with open(file_path, "rb") as f:
-            st.download_button(
-                label="Download Generated Code",
-                data=f.read(),
-                file_name=st.session_state.file_name,
-                mime="text/plain"
-            )
\ No newline at end of file
+        st.download_button(
+            label="Download Generated Code",
+            data=st.session_state.generated_code_bytes,
+            file_name=st.session_state.file_name,
+            mime="text/plain"
+        )
\ No newline at end of file